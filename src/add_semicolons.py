@@ -23,28 +23,40 @@
 # SOFTWARE.
 
 import re
+import sys
 import argparse
+from compressed_io import openFile
 
 def main():
     args = parseArguments()
 
-    processor = OldDEProcessor(args.inputFilePath)
+    processor = OldDEProcessor(args.inputFilePath, args.outputFilePath)
 
 def parseArguments():
     parser = argparse.ArgumentParser(description='Add semicolons to old Deleware election results text files')
     parser.add_argument('inputFilePath', type=str,
                         help='path to an old Delaware election results text file')
+    parser.add_argument('--output', dest='outputFilePath', type=str, default=None,
+                        help='write to this path instead of stdout (.gz, .xz or .zst compresses it)')
 
     return parser.parse_args()
 
 class OldDEProcessor(object):
-    def __init__(self, path):
+    def __init__(self, path, outputPath=None):
     	self.path = path
+    	self.outputPath = outputPath
 
     	self.process()
 
     def process(self):
-    	with open(self.path, 'r') as file:
+    	if self.outputPath:
+    		with openFile(self.outputPath, 'w') as output:
+    			self.processInto(output)
+    	else:
+    		self.processInto(sys.stdout)
+
+    def processInto(self, output):
+    	with openFile(self.path, 'r') as file:
     		lines = file.readlines()
     		for index, line in enumerate(lines):
     			chars = list(line.rstrip())
@@ -72,7 +84,7 @@ class OldDEProcessor(object):
 		    						chars[i:i+3] = list(';;;')
 
 
-    			print(''.join(chars)+';')
+    			print(''.join(chars)+';', file=output)
 
 
 
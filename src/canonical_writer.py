@@ -0,0 +1,177 @@
+#!/usr/local/bin/python3
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+# Copyright (c) 2018 OpenElections
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all 
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE 
+# SOFTWARE.
+
+import os
+import csv
+import heapq
+import tempfile
+import contextlib
+
+# Canonical row order: rows of one contest are contiguous, so the sidecar index
+# can point at each contest's first row
+SORT_FIELDS = ['office', 'district', 'party', 'candidate', 'county', 'election_district']
+
+# A primary contest is one party's race; in a general, party varies per candidate
+PRIMARY_CONTEST_FIELDS = ['office', 'district', 'party']
+GENERAL_CONTEST_FIELDS = ['office', 'district']
+
+# Not ".csv", so the sidecar isn't mistaken for a results file by the data globs
+INDEX_SUFFIX = '.idx'
+
+# Rough per-field cost of a row held in memory, on top of the text itself
+FIELD_OVERHEAD = 56
+
+# Most run files open at once; more runs are merged in rounds of this many
+MERGE_FAN_IN = 64
+
+
+class CountingWriter(object):
+	# Tracks how many bytes of CSV text have passed through to the output stream
+	def __init__(self, stream):
+		self.stream = stream
+		self.offset = 0
+
+	def write(self, text):
+		self.offset += len(text.encode('utf-8'))
+		return self.stream.write(text)
+
+
+class CanonicalWriter(object):
+	# Writes rows sorted by SORT_FIELDS. Rows are sorted in memory up to
+	# memoryBudget bytes, spilled to temporary run files beyond that and then
+	# merged, so the input can be larger than memory. Run files stay closed
+	# until merged, at most MERGE_FAN_IN at a time.
+	def __init__(self, fields, memoryBudget=64 * 1024 * 1024, contestFields=GENERAL_CONTEST_FIELDS):
+		if memoryBudget <= 0:
+			raise ValueError("memoryBudget must be positive, got {}".format(memoryBudget))
+
+		self.fields = list(fields)
+		self.memoryBudget = memoryBudget
+		self.contestFields = list(contestFields)
+		self.sortColumns = [self.fields.index(field) for field in SORT_FIELDS]
+		self.contestColumns = [self.fields.index(field) for field in self.contestFields]
+
+	def sortKey(self, row):
+		return tuple(row[i] or '' for i in self.sortColumns)
+
+	def rowSize(self, row):
+		return sum(len(str(value)) if value is not None else 0 for value in row) + FIELD_OVERHEAD * len(row)
+
+	def sortedRuns(self, rows, tempdir):
+		runs = []
+		buffer = []
+		bufferSize = 0
+
+		for row in rows:
+			row = ['' if value is None else str(value) for value in row]
+			buffer.append(row)
+			bufferSize += self.rowSize(row)
+
+			if bufferSize >= self.memoryBudget:
+				runs.append(self.spill(buffer, tempdir))
+				buffer = []
+				bufferSize = 0
+
+		buffer.sort(key=self.sortKey)
+		return runs, buffer
+
+	def spill(self, buffer, tempdir):
+		buffer.sort(key=self.sortKey)
+		return self.writeRun(buffer, tempdir)
+
+	def writeRun(self, rows, tempdir):
+		with tempfile.NamedTemporaryFile('w', dir=tempdir, suffix='.csv', delete=False, encoding='utf-8', newline='') as run:
+			csv.writer(run, lineterminator='\n').writerows(rows)
+
+		return run.name
+
+	@contextlib.contextmanager
+	def openRuns(self, runs):
+		with contextlib.ExitStack() as stack:
+			yield [csv.reader(stack.enter_context(open(run, 'r', encoding='utf-8', newline=''))) for run in runs]
+
+	def mergeRuns(self, runs, tempdir):
+		with self.openRuns(runs) as readers:
+			merged = self.writeRun(heapq.merge(*readers, key=self.sortKey), tempdir)
+
+		for run in runs:
+			os.remove(run)
+
+		return merged
+
+	def sortedRows(self, rows):
+		with tempfile.TemporaryDirectory() as tempdir:
+			runs, buffer = self.sortedRuns(rows, tempdir)
+
+			if not runs:
+				yield from buffer
+				return
+
+			while len(runs) > MERGE_FAN_IN:
+				runs = [self.mergeRuns(runs[i:i + MERGE_FAN_IN], tempdir) for i in range(0, len(runs), MERGE_FAN_IN)]
+
+			with self.openRuns(runs) as readers:
+				yield from heapq.merge(*readers, buffer, key=self.sortKey)
+
+	def write(self, stream, rows):
+		# Write the header and sorted rows to stream. Returns the contest index:
+		# a list of contest field values followed by the byte offset and row
+		# count, with offsets into the uncompressed CSV text.
+		out = CountingWriter(stream)
+		writer = csv.writer(out, lineterminator='\n')
+		writer.writerow(self.fields)
+
+		index = []
+		contest = None
+
+		for row in self.sortedRows(rows):
+			key = [row[i] for i in self.contestColumns]
+
+			if key != contest:
+				contest = key
+				index.append(key + [out.offset, 0])
+
+			index[-1][-1] += 1
+			writer.writerow(row)
+
+		return index
+
+	def writeIndex(self, path, index):
+		with open(path, 'w', newline='') as f:
+			writer = csv.writer(f, lineterminator='\n')
+			writer.writerow(self.contestFields + ['offset', 'rows'])
+			writer.writerows(index)
+
+
+def indexPathFor(outputPath):
+	# "20201103__de__general__precinct.csv.gz" -> "20201103__de__general__precinct.csv.gz.idx"
+	return outputPath + INDEX_SUFFIX
+
+def readIndex(path):
+	# {(office, district[, party]): (offset, rows)} from a sidecar written by CanonicalWriter
+	with open(path, 'r', newline='') as f:
+		reader = csv.reader(f)
+		next(reader) # header
+
+		return {tuple(row[:-2]): (int(row[-2]), int(row[-1])) for row in reader}
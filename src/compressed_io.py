@@ -0,0 +1,122 @@
+#!/usr/local/bin/python3
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+# Copyright (c) 2018 OpenElections
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all 
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE 
+# SOFTWARE.
+
+import os
+import io
+import glob
+import gzip
+import lzma
+
+# Magic bytes at the start of each supported compressed stream
+MAGIC_BYTES = {
+	'gzip': b'\x1f\x8b',
+	'xz': b'\xfd7zXZ\x00',
+	'zstd': b'\x28\xb5\x2f\xfd',
+}
+
+EXTENSIONS = {
+	'.gz': 'gzip',
+	'.xz': 'xz',
+	'.zst': 'zstd',
+}
+
+
+def compressionFromExtension(path):
+	return EXTENSIONS.get(os.path.splitext(path)[1].lower())
+
+def compressionFromMagic(path):
+	with open(path, 'rb') as f:
+		head = f.read(max(len(magic) for magic in MAGIC_BYTES.values()))
+
+	for compression, magic in MAGIC_BYTES.items():
+		if head.startswith(magic):
+			return compression
+
+	return None
+
+def stripCompressionExtension(path):
+	# "results.csv.gz" -> "results.csv"
+	if compressionFromExtension(path):
+		return os.path.splitext(path)[0]
+
+	return path
+
+def globCompressed(pattern):
+	# Paths matching pattern exactly or followed by a supported compression
+	# extension, so "*.csv" finds "a.csv" and "b.csv.gz" but not "a.csv.idx"
+	paths = glob.glob(pattern)
+
+	for extension in EXTENSIONS:
+		paths += glob.glob(pattern + extension)
+
+	return sorted(paths)
+
+# Open a plain, gzip, xz or zstd file as a text stream. When reading, the format
+# is detected from the magic bytes; when writing, from the extension.
+def openFile(path, mode='r', newline=None, compression=None):
+	if compression is None:
+		if 'r' in mode:
+			compression = compressionFromMagic(path)
+		else:
+			compression = compressionFromExtension(path)
+
+	mode = mode.replace('t', '').replace('b', '')
+
+	if compression == 'gzip':
+		return gzip.open(path, mode + 't', encoding='utf-8', newline=newline)
+	elif compression == 'xz':
+		return lzma.open(path, mode + 't', encoding='utf-8', newline=newline)
+	elif compression == 'zstd':
+		return io.TextIOWrapper(openZstd(path, mode + 'b'), encoding='utf-8', newline=newline)
+
+	return open(path, mode, newline=newline)
+
+# Open a plain, gzip, xz or zstd file for reading as bytes. Compressed streams
+# are seekable here, by offset into the uncompressed data.
+def openBinaryFile(path, compression=None):
+	if compression is None:
+		compression = compressionFromMagic(path)
+
+	if compression == 'gzip':
+		return gzip.open(path, 'rb')
+	elif compression == 'xz':
+		return lzma.open(path, 'rb')
+	elif compression == 'zstd':
+		return openZstd(path, 'rb')
+
+	return open(path, 'rb')
+
+def openZstd(path, mode):
+	try:
+		from compression import zstd # Python 3.14+
+		return zstd.open(path, mode)
+	except ImportError:
+		pass
+
+	try:
+		import zstandard
+	except ImportError:
+		raise ValueError("Reading or writing {} requires the 'zstandard' package".format(path))
+
+	return zstandard.open(path, mode)
@@ -26,17 +26,45 @@ import re
 import csv
 import sys
 import os
+import json
+import time
+import hashlib
+import tempfile
 import argparse
+import logging
 import collections
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from compressed_io import openFile
+from ed_crosswalk import districtsFileForDate
+from canonical_writer import CanonicalWriter, indexPathFor, PRIMARY_CONTEST_FIELDS, GENERAL_CONTEST_FIELDS
+
+logger = logging.getLogger('de-parser')
+
+ParseError = collections.namedtuple('ParseError', 'line message')
+Result = collections.namedtuple('Result', 'county election_district office district party candidate election_day absentee votes')
 
 def main():
     args = parseArguments()
+    configureLogging(args)
+
+    cache = ChunkCache(args.cacheDir, args.cacheMaxSize * 1024 * 1024, args.cacheMaxAge * 86400) if args.cacheDir else None
+
+    parser = DEParser(args.inputFilePath, args.outDirPath, args.compression, cache, args.jobs)
+    parser.reportErrors()
+    parser.writeOut(args.canonical, args.sortMemory * 1024 * 1024)
 
-    parser = DEParser(args.inputFilePath, args.outDirPath)
-    parser.writeOut()
+def configureLogging(args):
+    level = logging.INFO
+    if args.quiet:
+        level = logging.WARNING
+    elif args.verbose:
+        level = logging.DEBUG
+
+    logging.basicConfig(format='%(message)s', level=level)
 
 
 class DEParser(object):
+    voteColumns = 3 # election_day, absentee, votes
     office_mapping = {
         'PRESIDENT': 'President',
         'UNITED STATES SENATOR': 'U.S. Senate',
@@ -48,40 +76,41 @@ class DEParser(object):
         'STATE REPRESENTATIVE': 'State Assembly'
     }
 
-    def __init__(self, inputFilePath, outDirPath):
+    def __init__(self, inputFilePath, outDirPath, compression=None, cache=None, jobs=1):
         self.inputFilePath = inputFilePath
+        self.compression = compression
+        self.cache = cache
+        self.jobs = jobs
         self.date = None
         self.outDirPath = outDirPath
         self.processed = []
+        self.errors = []
         self.district_lookup = {}
+        self.districtsFile = None
         self.raw = []
         self.chunks = []
         self.election_type = None
         self.Chunk = collections.namedtuple('Chunk', 'office text')
-        self.Result = collections.namedtuple('Result', 'county election_district office district party candidate election_day absentee votes')
+        self.Result = Result
 
         self.readIn()
         self.splitIntoChunks()
-        print(f'Creating file for election on {self.date}')
+        logger.info('Creating file for election on %s', self.date)
         self.readInDistricts()
         self.process()
 
     def readIn(self):
-        with open(self.inputFilePath, "r") as text_file:
+        with openFile(self.inputFilePath, "r") as text_file:
             self.raw = text_file.read().splitlines()
 
     def readInDistricts(self):
-        districtsFile = None
-        
-        if self.date > "20120424" and self.date <= "20221108":
-            districtsFile = "election_districts_2012-2022.csv"
-        elif self.date > "20021105" and self.date <= "20120424":
-            districtsFile = "election_districts_2002-2012.csv"
+        districtsFile = districtsFileForDate(self.date)
 
-        print(f"Using ED file {districtsFile}")
+        logger.info("Using ED file %s", districtsFile)
+        self.districtsFile = districtsFile
 
         if districtsFile:
-            with open(districtsFile, "rU") as lookup_file:
+            with openFile(districtsFile, "r", newline="") as lookup_file:
                 for row in csv.DictReader(lookup_file):
                     self.district_lookup[row['election_district']] = row['county']
         else:
@@ -103,78 +132,288 @@ class DEParser(object):
             elif len(re.findall(';', row)) == 1 and len(row) > 5:
                 # print(row)
                 if lastchunkstart:
-                    self.chunks.append(Chunk(self.raw[lastchunkstart:i]))
+                    self.chunks.append(Chunk(self.raw[lastchunkstart:i], lastchunkstart))
 
                 lastchunkstart = i
 
         # After finishing, append the last chunk
-        self.chunks.append(Chunk(self.raw[lastchunkstart:]))
+        self.chunks.append(Chunk(self.raw[lastchunkstart:], lastchunkstart))
+
+    @classmethod
+    def chunkProcessor(cls, district_lookup):
+        # A bare parser that only runs processChunk, e.g. inside a worker process
+        parser = cls.__new__(cls)
+        parser.district_lookup = district_lookup
+        return parser
 
     def process(self):
-        for chunk in filter(lambda c: c.recognizedOffice == True, self.chunks):
-            header = []
-            lastED = None
-
-            for i, line in enumerate(chunk.resultLines):
-                line = [cell.strip() for cell in line.split(';')]
-                # print(i, line)
-                
-                if line[0] == "District":
-                    header = [] # Reset candidate header
-                    nextLine = [c.strip() for c in chunk.resultLines[i+1].split(';')]
-
-                    for j, cell in enumerate(line):
-                        candidateName = cell.title()
-                        if j <= len(nextLine) and candidateName and candidateName not in ['District', 'Total']:
-                            header.append((candidateName, nextLine[j]))
+        chunks = [c for c in self.chunks if c.recognizedOffice]
+        cached = [self.cache.get(c, self.districtsFile) if self.cache else None for c in chunks]
+        parsed = iter(self.processChunks([c for c, entry in zip(chunks, cached) if entry is None]))
+        reused = 0
+
+        # Merge cached and freshly parsed chunks back in their original order
+        for chunk, entry in zip(chunks, cached):
+            if entry:
+                results, errors = entry
+                reused += 1
+            else:
+                results, errors = next(parsed)
+
+                if self.cache:
+                    self.cache.put(chunk, self.districtsFile, results, errors)
+
+            self.processed.extend(results)
+            self.errors.extend(errors)
+
+        if self.cache:
+            logger.info('Reused %d cached chunk(s)', reused)
+            self.cache.evict()
+
+    def processChunks(self, chunks):
+        if self.jobs <= 1 or len(chunks) <= 1:
+            return [self.processChunk(chunk) for chunk in chunks]
+
+        # Free-threaded builds can share this parser directly; otherwise each
+        # worker process gets its own copy of the district lookup only
+        if not getattr(sys, '_is_gil_enabled', lambda: True)():
+            with ThreadPoolExecutor(self.jobs) as executor:
+                return list(executor.map(self.processChunk, chunks))
+
+        with ProcessPoolExecutor(self.jobs, initializer=initChunkWorker, initargs=(self.district_lookup,)) as executor:
+            return list(executor.map(processChunkInWorker, chunks, chunksize=max(1, len(chunks) // (self.jobs * 4))))
+
+    def processChunk(self, chunk):
+        # Checked once so disabled debug output costs nothing inside the loop
+        debug = logger.isEnabledFor(logging.DEBUG)
+        results = []
+        errors = []
+
+        header = []
+        lastED = None
+        # Running sums per candidate, checked against the RD Tot and Cand Tot lines
+        rdTotals = {}
+        candTotals = {}
+
+        for i, line in enumerate(chunk.resultLines):
+            line = [cell.strip() for cell in line.split(';')]
+            if debug:
+                logger.debug('%d %s', i, line)
+            
+            if line[0] == "District":
+                header = [] # Reset candidate header
+                nextLine = [c.strip() for c in chunk.resultLines[i+1].split(';')]
+
+                for j, cell in enumerate(line):
+                    candidateName = cell.title()
+                    if j <= len(nextLine) and candidateName and candidateName not in ['District', 'Total']:
+                        header.append((candidateName, nextLine[j]))
+                    else:
+                        header.append(None)
+
+            elif not line[0]:
+                pass # skip party and column header rows
+
+            elif line[0] == "RD Tot":
+                errors += self.checkTotals(chunk, i, line, header, rdTotals)
+                rdTotals.clear()
+
+            else:
+                if line[0] == "Cand Tot":
+                    errors += self.checkTotals(chunk, i, line, header, candTotals)
+
+                for j, candidate in enumerate(header):
+                    if candidate:
+                        if line[0] == "Cand Tot":
+                            county = self.district_lookup[lastED]
+                            election_district = "Total"
                         else:
-                            header.append(None)
+                            try:
+                                county = self.district_lookup[line[0]]
+                                lastED = line[0]
+                            except:
+                                errors.append(ParseError(chunk.lineNumber(i), f"Can't find ED: {line[0]}"))
+                            election_district = line[0]
 
-                elif not line[0]:
-                    pass # skip party and column header rows
+                        try:
+                            def clean(str):
+                                return str.replace(',', '') or 0
+                                              # 'county election_district office district party candidate election_day absentee votes'
+                            result = Result(county, election_district, chunk.office, chunk.district, candidate[1], candidate[0], clean(line[j]), clean(line[j+1]), clean(line[j+2]))
+                            if debug:
+                                logger.debug('%s', result)
+                            results.append(result)
 
-                elif line[0] == "RD Tot":
-                    # print("Skipping RD Tot line")
-                    pass
-                    # county = self.district_lookup[lastED]
-                    # election_district = f"RD {lastED[3:5]} Total"
-
-                else:
-                    for j, candidate in enumerate(header):
-                        if candidate:
-                            if line[0] == "Cand Tot":
-                                county = self.district_lookup[lastED]
-                                election_district = "Total"
-                            else:
-                                try:
-                                    county = self.district_lookup[line[0]]
-                                    lastED = line[0]
-                                except:
-                                    print(f"ERROR: Can't find ED: {line[0]}")
-                                election_district = line[0]
+                            if election_district != "Total":
+                                self.addToTotals(line, j, candidate, rdTotals, candTotals)
+                        except:
+                            errors.append(ParseError(chunk.lineNumber(i), f"Failed adding result for {candidate} in ED-RD {line[0]}"))
 
-                            try:
-                                def clean(str):
-                                    return str.replace(',', '') or 0
-                                                  # 'county election_district office district party candidate election_day absentee votes'
-                                result = self.Result(county, election_district, chunk.office, chunk.district, candidate[1], candidate[0], clean(line[j]), clean(line[j+1]), clean(line[j+2]))
-                                # print(result)
-                                self.processed.append(result)
-                            except:
-                                print(f"ERROR: Failed adding result for {candidate} in ED-RD {line[0]}")
+        return results, errors
+
+    def voteCounts(self, line, j):
+        # (election_day, absentee, votes) for the candidate whose columns start at j
+        return tuple(int(line[k].replace(',', '') or 0) for k in range(j, j + self.voteColumns))
+
+    def addToTotals(self, line, j, candidate, *totals):
+        try:
+            counts = self.voteCounts(line, j)
+        except (ValueError, IndexError):
+            return # Reported when the total doesn't add up
+
+        for total in totals:
+            previous = total.get(candidate, (0,) * len(counts))
+            total[candidate] = tuple(a + b for a, b in zip(previous, counts))
 
+    def checkTotals(self, chunk, i, line, header, totals):
+        errors = []
 
-    def writeOut(self):
+        for j, candidate in enumerate(header):
+            if candidate:
+                expected = totals.get(candidate, (0,) * self.voteColumns)
+
+                try:
+                    reported = self.voteCounts(line, j)
+                except (ValueError, IndexError):
+                    reported = None
+
+                if reported != expected:
+                    errors.append(ParseError(chunk.lineNumber(i), f"{line[0]} for {candidate[0]} is {reported}, but its EDs add up to {expected}"))
+
+        return errors
+
+    def reportErrors(self):
+        for error in self.errors:
+            logger.error('ERROR: Line %d: %s', error.line, error.message)
+
+        if self.errors:
+            logger.warning('%d error(s) in %s', len(self.errors), self.inputFilePath)
+
+
+    def writeOut(self, canonical=False, sortMemory=64 * 1024 * 1024):
+        # With canonical, rows are sorted using up to sortMemory bytes and a
+        # per-contest offset index is written next to the output
         filename = f"{self.date}__de__{self.election_type}__precinct.csv"
-        with open(os.path.join(self.outDirPath, filename), 'w') as f:
-            writer = csv.writer(f, lineterminator='\n')
-            writer.writerow(self.Result._fields)
 
-            for result in self.processed:
-                writer.writerow(list(result))
+        if self.compression:
+            filename += f".{self.compression}"
+
+        outputPath = os.path.join(self.outDirPath, filename)
+
+        with openFile(outputPath, 'w', newline='') as f:
+            if canonical:
+                contestFields = PRIMARY_CONTEST_FIELDS if self.election_type == 'primary' else GENERAL_CONTEST_FIELDS
+                canonicalWriter = CanonicalWriter(self.Result._fields, sortMemory, contestFields)
+                index = canonicalWriter.write(f, self.processed)
+            else:
+                writer = csv.writer(f, lineterminator='\n')
+                writer.writerow(self.Result._fields)
+
+                for result in self.processed:
+                    writer.writerow(list(result))
+
+        if canonical:
+            canonicalWriter.writeIndex(indexPathFor(outputPath), index)
+
+workerParser = None
+
+def initChunkWorker(district_lookup):
+    global workerParser
+    workerParser = DEParser.chunkProcessor(district_lookup)
+
+def processChunkInWorker(chunk):
+    return workerParser.processChunk(chunk)
+
+
+class ChunkCache(object):
+    # Parsed rows and errors for each chunk, stored on disk as JSON and keyed by a
+    # hash of the chunk's raw text and the ED file in use. Bump version whenever
+    # processChunk changes what it produces.
+    version = 1
+
+    def __init__(self, cacheDir, maxBytes, maxAge):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.maxAge = maxAge
+
+        os.makedirs(cacheDir, exist_ok=True)
+
+    def path(self, chunk, districtsFile):
+        digest = hashlib.sha256(f"{self.version}\n{districtsFile}\n".encode('utf-8'))
+        digest.update('\n'.join(chunk.text).encode('utf-8'))
+        key = digest.hexdigest()
+        return os.path.join(self.cacheDir, key[:2], f"{key}.json")
+
+    def get(self, chunk, districtsFile):
+        path = self.path(chunk, districtsFile)
+
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+            os.utime(path) # Keep recently used entries from aging out
+        except (OSError, ValueError):
+            return None
+
+        # Error lines are stored relative to the chunk, which may have moved in a revised report
+        results = [Result(*row) for row in entry['results']]
+        errors = [ParseError(line + chunk.start, message) for line, message in entry['errors']]
+        return results, errors
+
+    def put(self, chunk, districtsFile, results, errors):
+        path = self.path(chunk, districtsFile)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        entry = {
+            'results': [list(result) for result in results],
+            'errors': [[error.line - chunk.start, error.message] for error in errors],
+        }
+
+        # Write to a file unique to this run, then rename, so concurrent runs
+        # sharing the cache never see or clobber a partial entry
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path), suffix='.tmp', delete=False) as f:
+            json.dump(entry, f)
+
+        try:
+            os.replace(f.name, path)
+        except OSError:
+            os.remove(f.name)
+            raise
+
+    def evict(self):
+        now = time.time()
+        entries = []
+
+        # Another run sharing the cache may remove an entry first
+        for directory, _, filenames in os.walk(self.cacheDir):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+
+                try:
+                    stat = os.stat(path)
+
+                    if now - stat.st_mtime > self.maxAge:
+                        os.remove(path) # Including .tmp files left by a run that crashed
+                    elif not filename.endswith('.tmp'): # Still being written by another run
+                        entries.append((stat.st_mtime, stat.st_size, path))
+                except FileNotFoundError:
+                    pass
+
+        # Drop the least recently used entries until the cache fits
+        size = sum(entry[1] for entry in entries)
+        for mtime, entrySize, path in sorted(entries):
+            if size <= self.maxBytes:
+                break
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entrySize
+
 
 class Chunk(object):
-    def __init__(self, text):
+    def __init__(self, text, start=0):
+        self.start = start # index of the office line in the raw report
         self.rawOffice = text[0].strip(';')
         self.office = None
         self.identifyOfficeAndDistrict()
@@ -200,15 +439,40 @@ class Chunk(object):
     def resultLines(self):
         return self.text[1:]
 
+    def lineNumber(self, resultIndex):
+        # 1-indexed line in the raw report for resultLines[resultIndex]
+        return self.start + resultIndex + 2
+
 def parseArguments():
     parser = argparse.ArgumentParser(description='Parse Delaware vote files into OpenElections format')
     parser.add_argument('inputFilePath', type=str,
                         help='path to the Delaware CSV file for a given election')
     parser.add_argument('outDirPath', type=str,
                         help='path to output the CSV file to')
-
-
-    return parser.parse_args()
+    parser.add_argument('--compress', dest='compression', choices=['gz', 'xz', 'zst'], default=None,
+                        help='compress the output CSV file (the input is decompressed automatically)')
+    parser.add_argument('--cacheDir', dest='cacheDir', type=str, default=None,
+                        help='reuse parsed rows for chunks unchanged since an earlier run, cached in this directory')
+    parser.add_argument('--cacheMaxSize', dest='cacheMaxSize', type=int, default=256, metavar='MB',
+                        help='evict the least recently used cache entries beyond this size')
+    parser.add_argument('--cacheMaxAge', dest='cacheMaxAge', type=int, default=30, metavar='DAYS',
+                        help='evict cache entries unused for this many days')
+    parser.add_argument('--jobs', '-j', dest='jobs', type=int, default=1,
+                        help='parse chunks in parallel on this many cores')
+    parser.add_argument('--canonical', dest='canonical', action='store_true',
+                        help='sort rows by office, district, party, candidate, county and ED, and write a per-contest offset index')
+    parser.add_argument('--sortMemory', dest='sortMemory', type=int, default=64, metavar='MB',
+                        help='sort this much of the output in memory before spilling to temporary files (with --canonical)')
+    parser.add_argument('--quiet', '-q', dest='quiet', action='store_true', help='Only report errors')
+    parser.add_argument('--verbose', '-v', dest='verbose', action='store_true', help='Log every chunk and result line')
+
+
+    args = parser.parse_args()
+
+    if args.sortMemory <= 0:
+        parser.error('--sortMemory must be a positive number of MB')
+
+    return args
 
 
 # Default function is main()
@@ -27,17 +27,37 @@ import csv
 import sys
 import os
 import argparse
+import logging
 import collections
+from compressed_io import openFile
+from ed_crosswalk import districtsFileForDate
+from canonical_writer import CanonicalWriter, indexPathFor, PRIMARY_CONTEST_FIELDS, GENERAL_CONTEST_FIELDS
 from itertools import tee, zip_longest
 
+logger = logging.getLogger('de-parser')
+
+ParseError = collections.namedtuple('ParseError', 'line message')
+
 def main():
     args = parseArguments()
+    configureLogging(args)
+
+    parser = DEParser(args.inputFilePath, args.outDirPath, args.compression)
+    parser.reportErrors()
+    parser.writeOut(args.canonical, args.sortMemory * 1024 * 1024)
 
-    parser = DEParser(args.inputFilePath, args.outDirPath)
-    parser.writeOut()
+def configureLogging(args):
+    level = logging.INFO
+    if args.quiet:
+        level = logging.WARNING
+    elif args.verbose:
+        level = logging.DEBUG
+
+    logging.basicConfig(format='%(message)s', level=level)
 
 
 class DEParser(object):
+    voteColumns = 1 # votes
     office_mapping = {
         'PRESIDENT': 'President',
         'UNITED STATES SENATOR': 'U.S. Senate',
@@ -49,11 +69,13 @@ class DEParser(object):
         'STATE REPRESENTATIVE': 'State Assembly'
     }
 
-    def __init__(self, inputFilePath, outDirPath):
+    def __init__(self, inputFilePath, outDirPath, compression=None):
         self.inputFilePath = inputFilePath
+        self.compression = compression
         self.date = None
         self.outDirPath = outDirPath
         self.processed = []
+        self.errors = []
         self.district_lookup = {}
         self.raw = []
         self.chunks = []
@@ -63,34 +85,28 @@ class DEParser(object):
 
         self.readIn()
         self.splitIntoChunks()
-        print(f'Creating file for election on {self.date}')
+        logger.info('Creating file for election on %s', self.date)
         self.readInDistricts()
         self.process()
 
     def readIn(self):
-        with open(self.inputFilePath, "r") as text_file:
+        with openFile(self.inputFilePath, "r") as text_file:
             self.raw = text_file.read().splitlines()
 
     def readInDistricts(self):
-        districtsFile = None
-        
-        if self.date > "20120424" and self.date <= "20221108":
-            districtsFile = "election_districts_2012-2022.csv"
-        elif self.date > "20011231" and self.date <= "20120424":
-            districtsFile = "election_districts_2002-2012.csv"
-        elif self.date > "19921103" and self.date <="20011231":
-            districtsFile = "election_districts_1992-2002.csv"
+        districtsFile = districtsFileForDate(self.date)
 
-        print(f"Using ED file {districtsFile}")
+        logger.info("Using ED file %s", districtsFile)
 
         if districtsFile:
-            with open(districtsFile, "rU") as lookup_file:
+            with openFile(districtsFile, "r", newline="") as lookup_file:
                 for row in csv.DictReader(lookup_file):
                     self.district_lookup[row['election_district']] = row['county']
         else:
             self.district_lookup = {}
 
     def splitIntoChunks(self):
+        debug = logger.isEnabledFor(logging.DEBUG)
         lastchunkstart = None
         self.chunks = []
 
@@ -104,23 +120,31 @@ class DEParser(object):
 
             # New chunk begins
             elif not (re.match(r" (DISTRICT|RD TOT|CAND TOT|\d\d-\d\d)", row) or len(row) == 0 or row[1] == ' '):
-                print(row)
+                if debug:
+                    logger.debug('%s', row)
                 if lastchunkstart:
-                    self.chunks.append(Chunk(self.raw[lastchunkstart:i]))
+                    self.chunks.append(Chunk(self.raw[lastchunkstart:i], lastchunkstart))
 
                 lastchunkstart = i
 
         # After finishing, append the last chunk
-        self.chunks.append(Chunk(self.raw[lastchunkstart:]))
+        self.chunks.append(Chunk(self.raw[lastchunkstart:], lastchunkstart))
 
     def process(self):
+        # Checked once so disabled debug output costs nothing inside the loop
+        debug = logger.isEnabledFor(logging.DEBUG)
+
         for chunk in filter(lambda c: c.recognizedOffice == True, self.chunks):
             header = []
             lastED = None
+            # Running sums per candidate, checked against the RD Tot and Cand Tot lines
+            rdTotals = {}
+            candTotals = {}
 
             for i, line in enumerate(chunk.resultLines):
                 line = self.splitLine(line)
-                print(i, line)
+                if debug:
+                    logger.debug('%d %s', i, line)
                 
                 if line[0] == "DISTRICT":
                     header = [] # Reset candidate header
@@ -137,10 +161,13 @@ class DEParser(object):
                     pass # skip party and column header rows
 
                 elif line[0] == "RD TOT":
-                    # print("Skipping RD Tot line")
-                    pass
+                    self.checkTotals(chunk, i, line, header, rdTotals)
+                    rdTotals.clear()
 
                 else:
+                    if line[0] == "CAND TOT":
+                        self.checkTotals(chunk, i, line, header, candTotals)
+
                     for j, candidate in enumerate(header):
                         if candidate:
                             if line[0] == "CAND TOT":
@@ -151,7 +178,7 @@ class DEParser(object):
                                     county = self.district_lookup[line[0]]
                                     lastED = line[0]
                                 except:
-                                    print(f"ERROR: Can't find ED: {line[0]}")
+                                    self.addError(chunk.lineNumber(i), f"Can't find ED: {line[0]}")
                                 election_district = line[0]
 
                             try:
@@ -159,10 +186,50 @@ class DEParser(object):
                                     return str.replace(',', '') or 0
                                                   # 'county election_district office district party candidate votes'
                                 result = self.Result(county, election_district, chunk.office, chunk.district, candidate[1], candidate[0], clean(line[j]))
-                                # print(result)
+                                if debug:
+                                    logger.debug('%s', result)
                                 self.processed.append(result)
+
+                                if election_district != "Total":
+                                    self.addToTotals(line, j, candidate, rdTotals, candTotals)
                             except:
-                                print(f"ERROR: Failed adding result for {candidate} in ED-RD {line[0]}")
+                                self.addError(chunk.lineNumber(i), f"Failed adding result for {candidate} in ED-RD {line[0]}")
+
+    def voteCounts(self, line, j):
+        return tuple(int(line[k].replace(',', '') or 0) for k in range(j, j + self.voteColumns))
+
+    def addToTotals(self, line, j, candidate, *totals):
+        try:
+            counts = self.voteCounts(line, j)
+        except (ValueError, IndexError):
+            return # Reported when the total doesn't add up
+
+        for total in totals:
+            previous = total.get(candidate, (0,) * len(counts))
+            total[candidate] = tuple(a + b for a, b in zip(previous, counts))
+
+    def checkTotals(self, chunk, i, line, header, totals):
+        for j, candidate in enumerate(header):
+            if candidate:
+                expected = totals.get(candidate, (0,) * self.voteColumns)
+
+                try:
+                    reported = self.voteCounts(line, j)
+                except (ValueError, IndexError):
+                    reported = None
+
+                if reported != expected:
+                    self.addError(chunk.lineNumber(i), f"{line[0]} for {candidate[0]} is {reported}, but its EDs add up to {expected}")
+
+    def addError(self, line, message):
+        self.errors.append(ParseError(line, message))
+
+    def reportErrors(self):
+        for error in self.errors:
+            logger.error('ERROR: Line %d: %s', error.line, error.message)
+
+        if self.errors:
+            logger.warning('%d error(s) in %s', len(self.errors), self.inputFilePath)
 
 
     def splitLine(self, line):
@@ -173,17 +240,34 @@ class DEParser(object):
         return [padded[i:j].strip() for i,j in zip_longest(start, end)]
 
 
-    def writeOut(self):
+    def writeOut(self, canonical=False, sortMemory=64 * 1024 * 1024):
+        # With canonical, rows are sorted using up to sortMemory bytes and a
+        # per-contest offset index is written next to the output
         filename = f"{self.date}__de__{self.election_type}__precinct.csv"
-        with open(os.path.join(self.outDirPath, filename), 'w') as f:
-            writer = csv.writer(f, lineterminator='\n')
-            writer.writerow(self.Result._fields)
 
-            for result in self.processed:
-                writer.writerow(list(result))
+        if self.compression:
+            filename += f".{self.compression}"
+
+        outputPath = os.path.join(self.outDirPath, filename)
+
+        with openFile(outputPath, 'w', newline='') as f:
+            if canonical:
+                contestFields = PRIMARY_CONTEST_FIELDS if self.election_type == 'primary' else GENERAL_CONTEST_FIELDS
+                canonicalWriter = CanonicalWriter(self.Result._fields, sortMemory, contestFields)
+                index = canonicalWriter.write(f, self.processed)
+            else:
+                writer = csv.writer(f, lineterminator='\n')
+                writer.writerow(self.Result._fields)
+
+                for result in self.processed:
+                    writer.writerow(list(result))
+
+        if canonical:
+            canonicalWriter.writeIndex(indexPathFor(outputPath), index)
 
 class Chunk(object):
-    def __init__(self, text):
+    def __init__(self, text, start=0):
+        self.start = start # index of the office line in the raw report
         self.rawOffice = text[0].strip(';')
         self.office = None
         self.identifyOfficeAndDistrict()
@@ -209,15 +293,33 @@ class Chunk(object):
     def resultLines(self):
         return list(filter(None, self.text[1:])) # Skip first line, which is the office, and all empty lines
 
+    def lineNumber(self, resultIndex):
+        # 1-indexed line in the raw report for resultLines[resultIndex], which skips empty lines
+        textIndexes = [k for k, line in enumerate(self.text) if k > 0 and line]
+        return self.start + textIndexes[resultIndex] + 1
+
 def parseArguments():
     parser = argparse.ArgumentParser(description='Parse Delaware vote files into OpenElections format')
     parser.add_argument('inputFilePath', type=str,
                         help='path to the Delaware CSV file for a given election')
     parser.add_argument('outDirPath', type=str,
                         help='path to output the CSV file to')
+    parser.add_argument('--compress', dest='compression', choices=['gz', 'xz', 'zst'], default=None,
+                        help='compress the output CSV file (the input is decompressed automatically)')
+    parser.add_argument('--canonical', dest='canonical', action='store_true',
+                        help='sort rows by office, district, party, candidate, county and ED, and write a per-contest offset index')
+    parser.add_argument('--sortMemory', dest='sortMemory', type=int, default=64, metavar='MB',
+                        help='sort this much of the output in memory before spilling to temporary files (with --canonical)')
+    parser.add_argument('--quiet', '-q', dest='quiet', action='store_true', help='Only report errors')
+    parser.add_argument('--verbose', '-v', dest='verbose', action='store_true', help='Log every chunk and result line')
+
+
+    args = parser.parse_args()
 
+    if args.sortMemory <= 0:
+        parser.error('--sortMemory must be a positive number of MB')
 
-    return parser.parse_args()
+    return args
 
 
 # Default function is main()
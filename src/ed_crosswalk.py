@@ -0,0 +1,254 @@
+#!/usr/local/bin/python3
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+# Copyright (c) 2018 OpenElections
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all 
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE 
+# SOFTWARE.
+
+import os
+import csv
+import json
+import hashlib
+import argparse
+import collections
+from compressed_io import openFile, openBinaryFile, globCompressed
+
+Epoch = collections.namedtuple('Epoch', 'name districtsFile start end')
+EDHistory = collections.namedtuple('EDHistory', 'epochs files')
+
+# Redistricting epochs, each covering elections after start and up to end (YYYYMMDD)
+EPOCHS = [
+	Epoch('1992-2002', 'election_districts_1992-2002.csv', '19921103', '20011231'),
+	Epoch('2002-2012', 'election_districts_2002-2012.csv', '20011231', '20120424'),
+	Epoch('2012-2022', 'election_districts_2012-2022.csv', '20120424', '20221108'),
+]
+
+INDEX_FILENAME = 'election_districts_crosswalk.json'
+
+def main():
+	args = parseArguments()
+
+	crosswalk = EDCrosswalk(args.rootPath)
+	crosswalk.load(forceRebuild=args.rebuild)
+	election_district = normalizeED(args.election_district)
+
+	for county, history in sorted(crosswalk.lookup(election_district, args.county).items()):
+		print(f"{county} {election_district}: {', '.join(epoch.name for epoch in history.epochs)}")
+
+		for path, runs in history.files.items():
+			print(f"  {path}: {sum(rows for offset, rows in runs)} rows")
+
+			if args.showRows:
+				for row in crosswalk.readRows(path, runs):
+					print(f"    {','.join(row)}")
+
+def epochForDate(date):
+	for epoch in EPOCHS:
+		if date > epoch.start and date <= epoch.end:
+			return epoch
+
+	return None
+
+def districtsFileForDate(date):
+	epoch = epochForDate(date)
+	return epoch.districtsFile if epoch else None
+
+def normalizeED(election_district):
+	# The 2020 files write "01~01" for the ED-RD code that older files write "01-01"
+	return election_district.strip().replace('~', '-')
+
+
+class EDCrosswalk(object):
+	# Indexes every ED code, then county, to the redistricting epochs it exists
+	# in and the result files that report it, with the byte offset and row count
+	# of each run of its rows. Stored in INDEX_FILENAME: a change to a district
+	# file rebuilds the whole index, a changed result file only its own entries.
+	version = 2
+
+	def __init__(self, rootPath='.'):
+		self.rootPath = rootPath
+		self.indexPath = os.path.join(rootPath, INDEX_FILENAME)
+		self.sources = {}
+		self.files = {}
+		self.eds = {}
+
+	def sourceHashes(self):
+		hashes = {}
+
+		for epoch in EPOCHS:
+			with open(os.path.join(self.rootPath, epoch.districtsFile), 'rb') as f:
+				hashes[epoch.districtsFile] = hashlib.sha1(f.read()).hexdigest()
+
+		return hashes
+
+	def resultFiles(self):
+		# {path relative to rootPath: [mtime, size]} for every result file
+		files = {}
+
+		for path in globCompressed(os.path.join(self.rootPath, '[0-9][0-9][0-9][0-9]', '*__precinct.csv')):
+			stat = os.stat(path)
+			files[os.path.relpath(path, self.rootPath)] = [stat.st_mtime_ns, stat.st_size]
+
+		return files
+
+	def load(self, forceRebuild=False):
+		hashes = self.sourceHashes()
+		files = self.resultFiles()
+		index = None
+
+		if not forceRebuild:
+			try:
+				with open(self.indexPath, 'r') as f:
+					index = json.load(f)
+
+				if index['version'] != self.version or index['sources'] != hashes:
+					index = None
+			except (OSError, ValueError, KeyError):
+				index = None
+
+		if index is None:
+			self.sources = hashes
+			self.files = {}
+			self.eds = {}
+			self.addDistricts()
+		else:
+			self.sources = index['sources']
+			self.files = index['files']
+			self.eds = index['eds']
+
+		changed = [path for path in sorted(set(self.files) | set(files)) if self.files.get(path) != files.get(path)]
+
+		for path in changed:
+			self.dropFile(path)
+
+			if path in files:
+				self.addFile(path)
+				self.files[path] = files[path]
+
+		if index is None or changed:
+			self.save()
+
+	def entry(self, county, election_district):
+		return self.eds.setdefault(election_district, {}).setdefault(county, {'epochs': 0, 'files': {}})
+
+	def addDistricts(self):
+		for bit, epoch in enumerate(EPOCHS):
+			with openFile(os.path.join(self.rootPath, epoch.districtsFile), 'r', newline='') as lookup_file:
+				for row in csv.DictReader(lookup_file):
+					self.entry(row['county'], normalizeED(row['election_district']))['epochs'] |= 1 << bit
+
+	def addFile(self, path):
+		# Runs of consecutive rows for each (county, ED), flattened to
+		# [offset, rows, offset, rows, ...] with offsets into the uncompressed text
+		runs = collections.defaultdict(list)
+		previous = None
+
+		with openFile(os.path.join(self.rootPath, path), 'r', newline='') as csvfile:
+			offset = 0
+			columns = None
+
+			for line in csvfile:
+				lineOffset = offset
+				offset += len(line.encode('utf-8'))
+				row = next(csv.reader([line]), None)
+
+				if columns is None:
+					columns = row
+					edColumn = 'election_district' if 'election_district' in columns else 'precinct'
+
+					if edColumn not in columns or 'county' not in columns:
+						return # County-level file
+					continue
+
+				if not row or len(row) != len(columns):
+					previous = None
+					continue
+
+				row = dict(zip(columns, row))
+				key = (row['county'], normalizeED(row[edColumn]))
+
+				if key == previous:
+					runs[key][-1] += 1
+				else:
+					runs[key] += [lineOffset, 1]
+					previous = key
+
+		for (county, election_district), fileRuns in runs.items():
+			if election_district and election_district != 'Total':
+				self.entry(county, election_district)['files'][path] = fileRuns
+
+	def dropFile(self, path):
+		self.files.pop(path, None)
+
+		for counties in self.eds.values():
+			for entry in counties.values():
+				entry['files'].pop(path, None)
+
+	def save(self):
+		index = {
+			'version': self.version,
+			'sources': self.sources,
+			'epochs': [epoch.name for epoch in EPOCHS],
+			'files': self.files,
+			'eds': self.eds,
+		}
+
+		with open(self.indexPath, 'w') as f:
+			json.dump(index, f, separators=(',', ':'), sort_keys=True)
+
+	def history(self, entry):
+		epochs = [epoch for bit, epoch in enumerate(EPOCHS) if entry['epochs'] & (1 << bit)]
+		files = {os.path.join(self.rootPath, path): list(zip(runs[::2], runs[1::2]))
+				 for path, runs in sorted(entry['files'].items())}
+
+		return EDHistory(epochs, files)
+
+	def lookup(self, election_district, county=None):
+		# {county: EDHistory} for every county with this ED code, or just the given county
+		counties = self.eds.get(normalizeED(election_district), {})
+
+		if county is not None:
+			counties = {county: counties[county]} if county in counties else {}
+
+		return {edCounty: self.history(entry) for edCounty, entry in counties.items()}
+
+	def readRows(self, path, runs):
+		# The CSV rows at each (offset, rows) run of a file returned by lookup()
+		with openBinaryFile(path) as f:
+			for offset, rows in runs:
+				f.seek(offset)
+				yield from csv.reader(f.readline().decode('utf-8') for i in range(rows))
+
+
+def parseArguments():
+	parser = argparse.ArgumentParser(description='Look up an election district across redistricting epochs and elections')
+	parser.add_argument('--county', dest='county', type=str, default=None, help='limit the lookup to one county')
+	parser.add_argument('--rows', dest='showRows', action='store_true', help='print the result rows for the ED from each file')
+	parser.add_argument('--rebuild', dest='rebuild', action='store_true', help='rebuild the crosswalk index even if it is current')
+	parser.add_argument('--root', dest='rootPath', type=str, default='.',
+						help='path to the repository root containing the district files')
+	parser.add_argument('election_district', type=str, help='ED-RD code, e.g. 01-01')
+
+	return parser.parse_args()
+
+
+# Default function is main()
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,329 @@
+#!/usr/local/bin/python3
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+# Copyright (c) 2018 OpenElections
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all 
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE 
+# SOFTWARE.
+
+import os
+import re
+import csv
+import json
+import time
+import argparse
+import threading
+import collections
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from compressed_io import openFile, globCompressed, stripCompressionExtension
+from ed_crosswalk import normalizeED
+
+def main():
+	args = parseArguments()
+
+	index = ResultsIndex(args.rootPath)
+	index.loadAll()
+	print(f"Loaded {len(index.elections)} elections from {args.rootPath}")
+
+	if args.pollInterval > 0:
+		watcher = threading.Thread(target=index.watch, args=(args.pollInterval,), daemon=True)
+		watcher.start()
+
+	server = ResultsServer((args.host, args.port), index, args.cacheSize)
+	print(f"Serving on http://{args.host}:{args.port}")
+
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+
+
+def electionName(path):
+	# "2020/20200915__de__primary__precinct.csv.gz" -> "20200915__de__primary"
+	return os.path.basename(stripCompressionExtension(path)).replace('__precinct.csv', '')
+
+
+class ElectionFile(object):
+	# In-memory indexes over a single 20XX/*__precinct.csv file
+	def __init__(self, path):
+		self.path = path
+		self.election = electionName(path)
+		self.mtime = os.path.getmtime(path)
+		self.generation = None # Set by ResultsIndex when this file is swapped in
+		self.rows = []
+		self.contests = collections.defaultdict(list)
+		self.districts = collections.defaultdict(list)
+		self.candidates = collections.defaultdict(list)
+
+		self.readIn()
+
+	def readIn(self):
+		with openFile(self.path, 'r', newline='') as csvfile:
+			for row in csv.DictReader(csvfile):
+				# The 2020 presidential primary calls the ED column 'precinct'
+				if 'election_district' not in row:
+					row['election_district'] = row.pop('precinct', '')
+
+				row['votes'] = self.toInt(row['votes'])
+				index = len(self.rows)
+				self.rows.append(row)
+
+				self.contests[(row['office'], row['district'])].append(index)
+				self.districts[normalizeED(row['election_district'])].append(index)
+				self.candidates[row['candidate']].append(index)
+
+	def toInt(self, value):
+		try:
+			return int(value.replace(',', ''))
+		except (AttributeError, ValueError):
+			return 0
+
+	def contest(self, office, district):
+		return [self.rows[i] for i in self.contests.get((office, district), [])]
+
+	def electionDistrict(self, election_district, county=None):
+		rows = (self.rows[i] for i in self.districts.get(normalizeED(election_district), []))
+		return [row for row in rows if county is None or row['county'] == county]
+
+	def candidate(self, candidate):
+		return [self.rows[i] for i in self.candidates.get(candidate, [])]
+
+
+class ResultsIndex(object):
+	# self.elections is never modified in place: each change swaps in a new
+	# dict under self.lock, so request threads can read it without locking
+	def __init__(self, rootPath):
+		self.rootPath = rootPath
+		self.elections = {}
+		self.failed = {} # path -> mtime of a file that couldn't be loaded
+		self.generation = 0
+		self.lock = threading.Lock()
+
+	def paths(self):
+		return globCompressed(os.path.join(self.rootPath, '[0-9][0-9][0-9][0-9]', '*__precinct.csv'))
+
+	def loadAll(self):
+		for path in self.paths():
+			self.load(path)
+
+	def load(self, path):
+		try:
+			electionFile = ElectionFile(path)
+		except Exception as e: # e.g. EOFError from a .gz that is still being written
+			print(f"ERROR: Can't load {path}: {e!r}")
+
+			try:
+				self.failed[path] = os.path.getmtime(path)
+			except OSError:
+				pass
+			return
+
+		self.failed.pop(path, None)
+
+		# Swap in the fully built file so readers never see a partial index
+		with self.lock:
+			self.generation += 1
+			electionFile.generation = self.generation
+
+			elections = dict(self.elections)
+			elections[electionFile.election] = electionFile
+			self.elections = elections
+
+	def refresh(self):
+		seen = set()
+
+		for path in self.paths():
+			election = electionName(path)
+			seen.add(election)
+			current = self.elections.get(election)
+
+			try:
+				mtime = os.path.getmtime(path)
+			except OSError:
+				continue
+
+			# Retry a file that failed to load only once it changes again
+			changed = (current is None or mtime != current.mtime) and self.failed.get(path) != mtime
+
+			if changed:
+				print(f"Reloading {path}")
+				self.load(path)
+
+		for election in set(self.elections) - seen:
+			print(f"Dropping {election}")
+			with self.lock:
+				elections = dict(self.elections)
+				elections.pop(election, None)
+				self.elections = elections
+				self.generation += 1
+
+	def watch(self, interval):
+		while True:
+			time.sleep(interval)
+
+			# Keep watching whatever goes wrong with one pass
+			try:
+				self.refresh()
+			except Exception as e:
+				print(f"ERROR: Can't refresh {self.rootPath}: {e!r}")
+
+
+class LRUCache(object):
+	def __init__(self, maxSize):
+		self.maxSize = maxSize
+		self.entries = collections.OrderedDict()
+		self.lock = threading.Lock()
+
+	def get(self, key):
+		with self.lock:
+			if key in self.entries:
+				self.entries.move_to_end(key)
+				return self.entries[key]
+
+		return None
+
+	def put(self, key, value):
+		with self.lock:
+			self.entries[key] = value
+			self.entries.move_to_end(key)
+
+			while len(self.entries) > self.maxSize:
+				self.entries.popitem(last=False)
+
+
+class ResultsServer(ThreadingHTTPServer):
+	daemon_threads = True
+
+	def __init__(self, address, index, cacheSize):
+		super().__init__(address, ResultsRequestHandler)
+		self.index = index
+		self.cache = LRUCache(cacheSize)
+
+
+class ResultsRequestHandler(BaseHTTPRequestHandler):
+	routes = {
+		'/elections': 'elections',
+		'/contests': 'contests',
+		'/contest': 'contest',
+		'/ed': 'electionDistrict',
+		'/candidate': 'candidate',
+	}
+
+	def do_GET(self):
+		url = urlparse(self.path)
+		route = self.routes.get(url.path)
+
+		if not route:
+			return self.respond(404, {'error': f"Unknown path {url.path}"})
+
+		query = {key: values[-1] for key, values in parse_qs(url.query, keep_blank_values=True).items()}
+
+		try:
+			self.respond(200, getattr(self, route)(query))
+		except LookupError as e:
+			self.respond(404, {'error': str(e)})
+
+	def respond(self, status, payload):
+		body = payload if isinstance(payload, bytes) else json.dumps(payload).encode('utf-8')
+
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass # Keep the terminal quiet under dashboard load
+
+	def electionFile(self, query):
+		election = query.get('election')
+		electionFile = self.server.index.elections.get(election)
+
+		if electionFile is None:
+			raise LookupError(f"Unknown election: {election}")
+
+		return electionFile
+
+	def elections(self, query):
+		return sorted(self.server.index.elections)
+
+	def contests(self, query):
+		electionFile = self.electionFile(query)
+		return [{'office': office, 'district': district} for office, district in electionFile.contests]
+
+	def contest(self, query):
+		electionFile = self.electionFile(query)
+		office, district = query.get('office', ''), query.get('district', '')
+
+		# Aggregated responses are cached per loaded file, so a reload invalidates them
+		# and a response is never cached under a file it wasn't computed from
+		key = ('contest', electionFile.election, electionFile.generation, office, district)
+		cached = self.server.cache.get(key)
+
+		if cached is not None:
+			return cached
+
+		rows = electionFile.contest(office, district)
+
+		if not rows:
+			raise LookupError(f"Unknown contest: {office} {district}".strip())
+
+		totals = collections.OrderedDict()
+		for row in rows:
+			if row['election_district'] != 'Total' and row['candidate'] != 'Total':
+				candidate = (row['candidate'], row['party'])
+				totals[candidate] = totals.get(candidate, 0) + row['votes']
+
+		body = json.dumps({
+			'election': electionFile.election,
+			'office': office,
+			'district': district,
+			'candidates': [{'candidate': c, 'party': p, 'votes': v} for (c, p), v in totals.items()],
+		}).encode('utf-8')
+
+		self.server.cache.put(key, body)
+		return body
+
+	def electionDistrict(self, query):
+		electionFile = self.electionFile(query)
+		return electionFile.electionDistrict(query.get('election_district', ''), query.get('county'))
+
+	def candidate(self, query):
+		electionFile = self.electionFile(query)
+		return electionFile.candidate(query.get('candidate', ''))
+
+
+def parseArguments():
+	parser = argparse.ArgumentParser(description='Serve Delaware precinct results as read-only JSON')
+	parser.add_argument('--host', dest='host', type=str, default='127.0.0.1')
+	parser.add_argument('--port', dest='port', type=int, default=8000)
+	parser.add_argument('--cacheSize', dest='cacheSize', type=int, default=1024, help='Number of aggregated responses to keep in the LRU cache')
+	parser.add_argument('--pollInterval', dest='pollInterval', type=float, default=2.0, help='Seconds between checks for changed files (0 disables reloading)')
+	parser.add_argument('rootPath', nargs='?', type=str, default='.',
+						help='path to the repository root containing the 20XX directories')
+
+	return parser.parse_args()
+
+
+# Default function is main()
+if __name__ == '__main__':
+	main()
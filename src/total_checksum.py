@@ -22,70 +22,175 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE 
 # SOFTWARE.
 
+import io
 import csv
 import os
 import argparse
+import itertools
+import contextlib
+import collections
 import pandas
+from concurrent.futures import ProcessPoolExecutor
+from compressed_io import openFile
 
 
 def main():
 	args = parseArguments()
 
-	for path in args.paths:
-		checker = TotalChecker(path, args.excludeOverUnder)
-		checker.singleError = args.singleError
-		sortColumns = ['office', 'district']
+	if args.jobs > 1 and len(args.paths) > 1:
+		# Each file is checked in its own process; output is printed in path order
+		with ProcessPoolExecutor(args.jobs) as executor:
+			for output in executor.map(checkPathCapturingOutput, args.paths, itertools.repeat(args)):
+				print(output, end='')
+	else:
+		for path in args.paths:
+			checkPath(path, args)
 
-		if not args.isGeneral:
-			sortColumns += ['party']
+def checkPathCapturingOutput(path, args):
+	output = io.StringIO()
 
-		# Candidate total
-		checkedCandidateTotals = checker.checkTotals(checker.precinctColName, sortColumns + ['candidate'])
+	with contextlib.redirect_stdout(output):
+		checkPath(path, args)
 
-		# Precinct total
-		checkedPrecinctTotals = checker.checkTotals('candidate', sortColumns + [checker.precinctColName])
+	return output.getvalue()
 
-		if not checkedCandidateTotals and not checkedPrecinctTotals:
-			print("No totals to check")
+def checkPath(path, args):
+	checker = TotalChecker(path, args.excludeOverUnder, args.chunkSize)
+	checker.singleError = args.singleError
+	sortColumns = ['office', 'district']
+
+	if not args.isGeneral:
+		sortColumns += ['party']
+
+	# Candidate and precinct level sums, plus county level when it is printed
+	rollups = [sortColumns + ['candidate'], sortColumns + [checker.precinctColName]]
+
+	if args.showTotals == 'county':
+		rollups.append(sortColumns + ['candidate', 'county'])
+
+	checker.aggregate(rollups)
+
+	# Candidate total
+	checkedCandidateTotals = checker.checkTotals(checker.precinctColName, sortColumns + ['candidate'])
+
+	# Precinct total
+	checkedPrecinctTotals = checker.checkTotals('candidate', sortColumns + [checker.precinctColName])
+
+	if not checkedCandidateTotals and not checkedPrecinctTotals:
+		print("No totals to check")
+
+	if args.showTotals == 'county':
+		checker.printTotals(sortColumns + ['candidate', 'county'])
+	elif args.showTotals == 'statewide':
+		checker.printTotals(sortColumns + ['candidate'])
 
 
 class TotalChecker(object):
-	def __init__(self, path, excludeOverUnder):
+	def __init__(self, path, excludeOverUnder, chunkSize=None):
 		self.path = path
 		self.singleError = False
 		self.excludeOverUnder = excludeOverUnder
+		self.chunkSize = chunkSize
+		self.rollups = {}
 
 		print("==> {}".format(os.path.basename(path)))
 
-		self.populateResults()
+		if chunkSize:
+			self.readHeader()
+		else:
+			self.populateResults()
+
+	def readHeader(self):
+		with openFile(self.path, 'r', newline='') as csvfile:
+			header = next(csv.reader(csvfile))
+
+		self.columnNames = header
+		self.precinctColName = 'election_district' if 'election_district' in header else 'precinct'
 
 	def populateResults(self):
-		self.results = pandas.read_csv(self.path).fillna('')
+		with openFile(self.path, 'r', newline='') as csvfile:
+			self.results = pandas.read_csv(csvfile).fillna('')
 
+		self.columnNames = list(self.results)
 		self.precinctColName = 'election_district' if 'election_district' in list(self.results) else 'precinct'
+		self.results = self.prepareResults(self.results)
+		self.results_sans_totals = self.withoutTotals(self.results)
 
-		self.results[['votes']] = self.results[['votes']].apply(pandas.to_numeric)
-		self.results[self.precinctColName] = self.results[self.precinctColName].astype(str)
+	def prepareResults(self, results):
+		results[['votes']] = results[['votes']].apply(pandas.to_numeric)
+		results[self.precinctColName] = results[self.precinctColName].astype(str)
 		
 		if self.excludeOverUnder:
-			self.results = self.results[(self.results.candidate != 'Over Votes') & 
-										(self.results.candidate != 'Under Votes')]
+			results = results[(results.candidate != 'Over Votes') & 
+							  (results.candidate != 'Under Votes')]
+
+		return results
+
+	def withoutTotals(self, results):
+		return results.loc[(results.candidate != 'Total') & (results[self.precinctColName] != 'Total')]
+
+	def onlyTotals(self, results):
+		return results.loc[(results.candidate == 'Total') | (results[self.precinctColName] == 'Total')]
 
-		self.results_sans_totals = self.results.loc[(self.results.candidate != 'Total') & (self.results[self.precinctColName] != 'Total')]
+	def presentColumns(self, columns):
+		return [col for col in columns if col in self.columnNames]
 
+	# Sums votes for each list of columns in rollups, and sets aside the Total
+	# rows to check against them
+	def aggregate(self, rollups):
+		rollups = [self.presentColumns(columns) for columns in rollups]
+
+		if self.chunkSize:
+			self.aggregateInChunks(rollups)
+		else:
+			# One aggregation over every key; rollup() reads each level off it
+			columns = []
+			for col in itertools.chain(*rollups):
+				if col not in columns:
+					columns.append(col)
+
+			self.cube = self.results_sans_totals.groupby(columns).votes.sum()
+			self.total_data = self.onlyTotals(self.results)
+
+	def aggregateInChunks(self, rollups):
+		# Streams the file in chunks of self.chunkSize rows, keeping only partial
+		# sums per group of each roll-up and the Total rows
+		sums = {tuple(columns): collections.defaultdict(int) for columns in rollups}
+		totalRows = []
+
+		with openFile(self.path, 'r', newline='') as csvfile:
+			# Read everything as strings so group keys match across chunks
+			for chunk in pandas.read_csv(csvfile, chunksize=self.chunkSize, dtype=str, keep_default_na=False):
+				chunk = self.prepareResults(chunk)
+				chunk_sans_totals = self.withoutTotals(chunk)
+
+				for columns, groupSums in sums.items():
+					for key, votes in chunk_sans_totals.groupby(list(columns)).votes.sum().items():
+						groupSums[key] += votes
+
+				totalRows.append(self.onlyTotals(chunk))
+
+		self.cube = None
+		self.rollups.update(sums)
+		self.total_data = pandas.concat(totalRows)
+
+	def rollup(self, columns):
+		if tuple(columns) not in self.rollups:
+			self.rollups[tuple(columns)] = self.cube.groupby(level=columns).sum()
+
+		return self.rollups[tuple(columns)]
 
 	def checkTotals(self, totalColumn, columns):
-		contests = self.results.drop_duplicates(columns)[columns].values
-		total_data = self.results.loc[self.results[totalColumn] == 'Total']
+		total_data = self.total_data.loc[self.total_data[totalColumn] == 'Total']
 		
 		if len(total_data):
-			# Calculate our own totals to compare
-			totals = self.results_sans_totals.groupby(columns).votes.sum()
+			# Our own totals to compare, read off the aggregation
+			totals = self.rollup(columns)
 
 			for index, row in total_data.iterrows():
 				file_total = row.votes
 				index_values = tuple(row[x] for x in columns)
-				actual_total = totals.loc[index_values]
+				actual_total = totals.get(index_values, 0)
 
 				if file_total != actual_total:
 					lineNo = index + 2 # 1 for header, 1 for zero-indexing
@@ -101,12 +206,26 @@ class TotalChecker(object):
 
 		return False
 
+	def printTotals(self, columns):
+		columns = self.presentColumns(columns)
+		totals = self.rollup(columns)
+
+		if not isinstance(totals, pandas.Series):
+			totals = pandas.Series(dict(sorted(totals.items())), dtype='int64').rename_axis(columns)
+
+		print(totals.to_string())
+
 def parseArguments():
 	parser = argparse.ArgumentParser(description='Verify votes are correct using a simple checksum')
 	parser.add_argument('--verbose', '-v', dest='verbose', action='store_true')
 	parser.add_argument('--excludeOverUnder', dest='excludeOverUnder', action='store_true')
 	parser.add_argument('--singleError', dest='singleError', action='store_true', help='Display only the first error in each file')
-	parser.add_argument('paths', metavar='path', type=str, nargs='+', help='path to a CSV file')
+	parser.add_argument('--chunkSize', dest='chunkSize', type=int, default=None, metavar='ROWS',
+						help='Stream the file in chunks of this many rows instead of loading it whole')
+	parser.add_argument('--showTotals', dest='showTotals', choices=['county', 'statewide'], default=None,
+						help='Also print per-candidate vote totals at this level')
+	parser.add_argument('--jobs', '-j', dest='jobs', type=int, default=1, help='Check this many files in parallel')
+	parser.add_argument('paths', metavar='path', type=str, nargs='+', help='path to a CSV file, optionally gzip/xz/zstd-compressed')
 	parser.set_defaults(verbose=False)
 
 	# By default, the script will assume the file is a general, --general doesn't have to be specified (but can be).
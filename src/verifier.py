@@ -23,10 +23,15 @@
 # SOFTWARE.
 
 import pdb
+import gc
 import csv
 import os
 import re
 import argparse
+import hashlib
+import sqlite3
+import tempfile
+from compressed_io import openFile, stripCompressionExtension
 
 def main():
 	args = parseArguments()
@@ -36,6 +41,8 @@ def main():
 		verifier.showPrimaryPartiesError = not args.mutePrimaryPartiesError
 		verifier.showXForDistrictError = not args.muteXForDistrictError
 		verifier.singleErrorMode = args.singleError
+		verifier.uniqueMemoryBudget = args.uniqueMemoryBudget
+		verifier.columnarMode = args.columnar
 
 		if verifier.ready and "matrix" not in verifier.filename:
 			verifier.verify()
@@ -46,9 +53,13 @@ def parseArguments():
 	parser.add_argument('--mutePrimaryPartiesError', dest='mutePrimaryPartiesError', action='store_true')
 	parser.add_argument('--muteXForDistrictError', dest='muteXForDistrictError', action='store_true')
 	parser.add_argument('--singleError', dest='singleError', action='store_true', help='Display only the first error in each file')
+	parser.add_argument('--uniqueMemoryBudget', dest='uniqueMemoryBudget', type=float, default=None, metavar='MB',
+					   help='Bound the memory used for duplicate-row detection; duplicates are then confirmed in a second pass')
+	parser.add_argument('--columnar', dest='columnar', action='store_true',
+					   help='Check whole columns at once with numpy/pandas instead of row by row')
 	parser.set_defaults(mutePrimaryPartiesError=False, muteXForDistrictError=False)
 	parser.add_argument('paths', metavar='path', type=str, nargs='+',
-					   help='path to a CSV file')
+					   help='path to a CSV file, optionally gzip/xz/zstd-compressed')
 
 	return parser.parse_args()
 
@@ -92,6 +103,10 @@ class Verifier(object):
 		self.showPrimaryPartiesError = True
 		self.showXForDistrictError = True
 		self.singleErrorMode = False
+		self.uniqueMemoryBudget = None
+		self.columnarMode = False
+		self.uniqueRowFilter = None
+		self.duplicateSuspects = set()
 
 		self.countyRE = re.compile("\d{8}__[a-z]{2}_")
 
@@ -106,13 +121,16 @@ class Verifier(object):
 			print("ERROR: {}".format(e))
 
 	def verify(self):
-		self.parseFileAtPath(self.path)
+		if self.columnarMode:
+			self.parseColumnsAtPath(self.path)
+		else:
+			self.parseFileAtPath(self.path)
 
 	def pathSanityCheck(self, path):
 		if not os.path.exists(path) or not os.path.isfile(path):
 			raise FileNotFoundError("Can't find file at path %s" % path)
 
-		if not os.path.splitext(path)[1] == ".csv":
+		if not os.path.splitext(stripCompressionExtension(path))[1] == ".csv":
 			raise ValueError("Filename does not end in .csv: %s" % path)
 
 		print("==> {}".format(path))
@@ -132,11 +150,18 @@ class Verifier(object):
 		return (None, None)
 
 	def parseFileAtPath(self, path):
-		with open(path, 'rU') as csvfile:
+		with openFile(path, 'r', newline='') as csvfile:
 			self.reader = csv.DictReader(csvfile)
 			self.currentRowIndex = 0
 			self.headerColumnCount = 0
 			
+			if self.uniqueMemoryBudget:
+				# Half of the budget for the filter, a quarter each for the suspect
+				# fingerprints and for confirmDuplicates' first lines
+				budget = int(self.uniqueMemoryBudget * 1024 * 1024)
+				self.uniqueRowFilter = RowFingerprintFilter(budget // 2)
+				self.duplicateSuspects = SpillingFingerprintSet(budget // 4)
+
 			try:
 				if self.verifyColumns(self.reader.fieldnames):
 					for index, row in enumerate(self.reader):
@@ -150,8 +175,175 @@ class Verifier(object):
 						self.verifyParty(row)
 						self.verifyVotes(row)
 						self.verifyRowIsUnique(row)
+
+					if self.duplicateSuspects:
+						self.confirmDuplicates(path)
 			except StopIteration as si:
 				pass # Stop verifying when exception is thrown
+			finally:
+				if self.uniqueRowFilter:
+					self.duplicateSuspects.close()
+
+	# Columnar backend: the file is loaded into columns by pandas' C parser and
+	# each rule is evaluated once per distinct value, then broadcast back to every row.
+	# Failures are reported in the same line order as parseFileAtPath.
+	def parseColumnsAtPath(self, path):
+		with openFile(path, 'r', newline='') as csvfile:
+			reader = csv.reader(csvfile)
+			self.currentRowIndex = 0
+			self.headerColumnCount = 0
+
+			try:
+				columns = next(reader)
+			except StopIteration:
+				return
+
+			self.columnErrors = []
+			self.columnNames = columns
+			self.malformedRows = {}
+
+			try:
+				if self.verifyColumns(columns):
+					self.readColumns(csvfile, reader)
+
+					self.addColumnErrors(1, self.columnMessages(['office'], self.officeError))
+					self.addColumnErrors(2, self.columnMessages(['office', 'district'], self.districtError))
+					self.addColumnErrors(3, self.columnMessages(['candidate'], self.candidateError))
+					self.addColumnErrors(4, self.columnMessages(['candidate', 'party'], self.partyError))
+					self.addColumnErrors(5, self.columnMessages(['votes'], self.votesError))
+					self.verifyRowsAreUnique()
+
+				self.reportColumnErrors()
+			except StopIteration as si:
+				pass # Stop verifying when exception is thrown
+
+	def readColumns(self, csvfile, reader):
+		import pandas
+
+		width = self.headerColumnCount
+		self.columnFactors = {}
+
+		try:
+			frame = pandas.read_csv(csvfile, engine='c', header=None, names=list(range(width)), index_col=False,
+									dtype=str, keep_default_na=False, on_bad_lines='error')
+		except pandas.errors.EmptyDataError:
+			frame = pandas.DataFrame(columns=list(range(width)), dtype=object)
+		except pandas.errors.ParserError:
+			frame = None # A row has extra fields
+
+		# The C parser pads short rows with '', so an empty last field may be a
+		# short row. Either way, re-read with csv.reader to get exact row lengths.
+		if frame is None or (width and (frame[width - 1] == '').any()):
+			csvfile.seek(0)
+			next(reader) # header
+			self.readColumnsFromRows(reader)
+			return
+
+		self.columnData = {name: frame[i].to_numpy(dtype=object) for i, name in enumerate(self.columnNames)}
+		self.columnRowCount = len(frame)
+
+	def readColumnsFromRows(self, reader):
+		import numpy
+
+		# Millions of short-lived lists and tuples make the cyclic GC dominate load time
+		gcWasEnabled = gc.isenabled()
+		gc.disable()
+
+		try:
+			rows = [row for row in reader if row] # DictReader skips blank lines too
+			rowLengths = list(map(len, rows))
+			width = self.headerColumnCount
+
+			if rows and (min(rowLengths) != width or max(rowLengths) != width):
+				self.verifyColumnsOfRows(rowLengths)
+
+				# Pad or trim only the malformed rows so every column lines up,
+				# keeping the originals for printing
+				for i, length in enumerate(rowLengths):
+					if length != width:
+						self.malformedRows[i] = rows[i]
+						rows[i] = (rows[i] + [''] * width)[:width]
+
+			values = zip(*rows) if rows else [()] * width
+			self.columnData = {name: numpy.array(column, dtype=object) for name, column in zip(self.columnNames, values)}
+			self.columnRowCount = len(rows)
+			del rows
+		finally:
+			if gcWasEnabled:
+				gc.enable()
+
+	# Returns a code per row identifying its combination of values in the
+	# given columns, and the index of the first row with each code
+	def columnCodes(self, names):
+		import numpy
+		import pandas
+
+		combined = numpy.zeros(self.columnRowCount, dtype=numpy.int64)
+		for name in names:
+			if name not in self.columnFactors:
+				codes, uniques = pandas.factorize(self.columnData[name])
+				self.columnFactors[name] = (codes, len(uniques))
+
+			codes, uniqueCount = self.columnFactors[name]
+			# Re-factorize at each step so the combined codes can't overflow
+			combined, uniques = pandas.factorize(combined * uniqueCount + codes)
+
+		codes = combined
+		# factorize numbers codes 0..n-1, so the sorted uniques line up with them
+		# and return_index gives each code's first row
+		_, first = numpy.unique(codes, return_index=True)
+
+		return codes, first
+
+	def columnMessages(self, names, messageFunction):
+		import numpy
+
+		codes, first = self.columnCodes(names)
+		messages = [messageFunction(*(self.columnData[name][i] for name in names)) for i in first]
+		return numpy.array(messages, dtype=object)[codes]
+
+	# Rank orders errors on the same line the way the per-row checks would
+	def addColumnErrors(self, rank, messages):
+		import numpy
+
+		for i in numpy.flatnonzero(messages != None):
+			self.columnErrors.append((int(i) + 2, rank, messages[i])) # 1 for header; 1 for human-readable, 1-indexed list
+
+	def reportColumnErrors(self):
+		for line, rank, message in sorted(self.columnErrors, key=lambda error: error[:2]):
+			self.currentRowIndex = line
+			self.printError(message, self.columnRowDict(line))
+
+	def columnRowDict(self, line):
+		# Same shape as the csv.DictReader row, including any extra fields under None
+		index = line - 2
+		row = self.malformedRows.get(index) or [self.columnData[name][index] for name in self.columnNames]
+		rowDict = dict(zip(self.columnNames, row))
+
+		if len(row) > len(self.columnNames):
+			rowDict[None] = row[len(self.columnNames):]
+
+		return rowDict
+
+	def verifyColumnsOfRows(self, rowLengths):
+		for index, length in enumerate(rowLengths):
+			badColumnCount = length - self.headerColumnCount
+
+			if badColumnCount < 0:
+				self.columnErrors.append((index + 2, 0, "Row is missing {} column(s)".format(abs(badColumnCount))))
+			elif badColumnCount > 0:
+				# DictReader gathers all extra fields under one None key, so the
+				# row path counts them as one column
+				self.columnErrors.append((index + 2, 0, "Row has 1 extra column(s)"))
+
+	def verifyRowsAreUnique(self):
+		import numpy
+
+		codes, first = self.columnCodes(list(Verifier.uniqueRowIDSet))
+		originalRows = first[codes]
+
+		for i in numpy.flatnonzero(originalRows != numpy.arange(self.columnRowCount)):
+			self.columnErrors.append((int(i) + 2, 6, "Line is duplicated (original line {})".format(originalRows[i] + 2)))
 
 	def verifyColumns(self, columns):
 		self.headerColumnCount = len(columns)
@@ -188,55 +380,99 @@ class Verifier(object):
 		if not row['county'] == normalisedCounty:
 			self.printError("Use title case for the county", row)
 
+	# Each rule below is split into a check on the values, shared with the
+	# columnar backend, and a verify* method that reports it for a row
+
 	def verifyOffice(self, row):
-		if not row['office'] in Verifier.validOffices:
-			self.printError("Invalid office: {}".format(row['office']), row)
+		self.printRowError(self.officeError(row['office']), row)
+
+	def officeError(self, office):
+		if not office in Verifier.validOffices:
+			return "Invalid office: {}".format(office)
 
 	def verifyDistrict(self, row):
-		if row['office'] in Verifier.officesWithDistricts:
-			if not row['district']:
-				self.printError("Office '{}' requires a district".format(row['office']), row)
-			elif row['district'].lower() == 'x':
+		self.printRowError(self.districtError(row['office'], row['district']), row)
+
+	def districtError(self, office, district):
+		if office in Verifier.officesWithDistricts:
+			if not district:
+				return "Office '{}' requires a district".format(office)
+			elif district.lower() == 'x':
 				if not self.showXForDistrictError:
 					pass # Some counties use this, but we still want to make sure it's reviewed by default
 				else:
-					self.printError("District must be an integer", row)
-			elif not self.verifyInteger(row['district']):
-				self.printError("District must be an integer", row)
+					return "District must be an integer"
+			elif not self.verifyInteger(district):
+				return "District must be an integer"
 
 	def verifyCandidate(self, row):
+		self.printRowError(self.candidateError(row['candidate']), row)
+
+	def candidateError(self, candidate):
 		charsRE = re.compile('[^A-Za-z]+', re.UNICODE)
-		candidate = row['candidate']
 		normalizedCandidate = charsRE.sub('', candidate).lower()
 
 		if candidate not in Verifier.pseudocandidates:
 			if normalizedCandidate in Verifier.normalizedPseudocandidates:
-				self.printError("Misspelled pseudocandidate a: '{}'".format(candidate), row)
+				return "Misspelled pseudocandidate a: '{}'".format(candidate)
 			else:
 				# Compare the normalized strings to determine if they match
 				for npc in Verifier.normalizedPseudocandidates:
 					if normalizedCandidate.startswith(npc[0:4]): # Only check the first 4 characters
-						self.printError("Misspelled pseudocandidate b: '{}'".format(candidate), row)
-						break
+						return "Misspelled pseudocandidate b: '{}'".format(candidate)
 
 	def verifyParty(self, row):
-		if row['candidate'] not in Verifier.pseudocandidates and not row['party']:
-			self.printError("Party missing", row)
+		self.printRowError(self.partyError(row['candidate'], row['party']), row)
+
+	def partyError(self, candidate, party):
+		if candidate not in Verifier.pseudocandidates and not party:
+			return "Party missing"
 
 	def verifyVotes(self, row):
-		if not self.verifyInteger(row['votes']):
-			self.printError("Vote count must be an integer", row)
-		elif not int(row['votes']) >= 0:
-			self.printError("Vote count must be greater than or equal to zero", row)
+		self.printRowError(self.votesError(row['votes']), row)
+
+	def votesError(self, votes):
+		if not self.verifyInteger(votes):
+			return "Vote count must be an integer"
+		elif not int(votes) >= 0:
+			return "Vote count must be greater than or equal to zero"
 
 	def verifyRowIsUnique(self, row):
 		rowTuple = tuple(row[col] for col in Verifier.uniqueRowIDSet)
 
-		if rowTuple in self.uniqueRowIDs:
+		if self.uniqueRowFilter:
+			# Bounded memory: only remember fingerprints that may have been seen before
+			fingerprint = self.uniqueRowFilter.add(rowTuple)
+			if fingerprint is not None:
+				self.duplicateSuspects.add(fingerprint)
+		elif rowTuple in self.uniqueRowIDs:
 			self.printError("Line is duplicated (original line {})".format(self.uniqueRowIDs[rowTuple]), row)
 		else:
 			self.uniqueRowIDs[rowTuple] = self.currentRowIndex
 
+	def confirmDuplicates(self, path):
+		# Second pass: compare only rows whose fingerprints collided, keeping the
+		# first line of each in a store that spills to disk past the budget
+		firstLines = SpillingDict(int(self.uniqueMemoryBudget * 1024 * 1024) // 4)
+
+		try:
+			with openFile(path, 'r', newline='') as csvfile:
+				for index, row in enumerate(csv.DictReader(csvfile)):
+					rowTuple = tuple(row[col] for col in Verifier.uniqueRowIDSet)
+
+					if RowFingerprintFilter.fingerprint(rowTuple) not in self.duplicateSuspects:
+						continue
+
+					self.currentRowIndex = index + 2
+					originalLine = firstLines.get(rowTuple)
+
+					if originalLine is not None:
+						self.printError("Line is duplicated (original line {})".format(originalLine), row)
+					else:
+						firstLines.put(rowTuple, self.currentRowIndex)
+		finally:
+			firstLines.close()
+
 	def verifyInteger(self, numberStr):
 		try:
 			integer = int(numberStr)
@@ -245,6 +481,10 @@ class Verifier(object):
 
 		return True
 
+	def printRowError(self, text, row):
+		if text:
+			self.printError(text, row)
+
 	def printError(self, text, row=[]):
 		print("ERROR: Line {}: {}".format(self.currentRowIndex, text))
 
@@ -255,14 +495,147 @@ class Verifier(object):
 			raise StopIteration("Stop after first error")
 
 
+class RowFingerprintFilter(object):
+	# Bloom filter over row identities. add() returns the row's 64-bit fingerprint
+	# when the row may already have been seen, or None when it definitely hasn't.
+	hashCount = 4
+
+	def __init__(self, sizeInBytes):
+		self.bitCount = max(sizeInBytes, 1024) * 8
+		self.bits = bytearray(self.bitCount // 8)
+
+	@staticmethod
+	def digest(rowTuple):
+		key = '\x1f'.join(value or '' for value in rowTuple).encode('utf-8')
+		digest = hashlib.blake2b(key, digest_size=16).digest()
+		return int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little')
+
+	@staticmethod
+	def fingerprint(rowTuple):
+		return RowFingerprintFilter.digest(rowTuple)[0]
+
+	def add(self, rowTuple):
+		h1, h2 = self.digest(rowTuple)
+		seen = True
+
+		for i in range(self.hashCount):
+			bit = (h1 + i * h2) % self.bitCount
+			byte, mask = bit >> 3, 1 << (bit & 7)
+
+			if not self.bits[byte] & mask:
+				seen = False
+				self.bits[byte] |= mask
+
+		return h1 if seen else None
+
+
+class SpillingFingerprintSet(object):
+	# Set of 64-bit row fingerprints that moves to a temporary SQLite file once
+	# it outgrows its memory budget
+	bytesPerEntry = 64
+
+	def __init__(self, sizeInBytes):
+		self.sizeInBytes = sizeInBytes
+		self.maxEntries = max(sizeInBytes // SpillingFingerprintSet.bytesPerEntry, 1)
+		self.entries = set()
+		self.tempdir = None
+		self.db = None
+
+	def key(self, fingerprint):
+		return fingerprint - (1 << 63) # SQLite integers are signed
+
+	def __len__(self):
+		if self.db:
+			return self.db.execute("SELECT COUNT(*) FROM fingerprints").fetchone()[0]
+
+		return len(self.entries)
+
+	def __contains__(self, fingerprint):
+		if self.db:
+			return self.db.execute("SELECT 1 FROM fingerprints WHERE key = ?", (self.key(fingerprint),)).fetchone() is not None
+
+		return fingerprint in self.entries
+
+	def add(self, fingerprint):
+		if self.db:
+			self.db.execute("INSERT OR IGNORE INTO fingerprints VALUES (?)", (self.key(fingerprint),))
+			return
+
+		self.entries.add(fingerprint)
+
+		if len(self.entries) > self.maxEntries:
+			self.spill()
+
+	def spill(self):
+		self.tempdir = tempfile.TemporaryDirectory()
+		self.db = sqlite3.connect(os.path.join(self.tempdir.name, 'fingerprints.sqlite'))
+		self.db.execute("PRAGMA cache_size = -{}".format(max(self.sizeInBytes // 1024, 64))) # KiB, counted in the budget
+		self.db.execute("CREATE TABLE fingerprints (key INTEGER PRIMARY KEY)")
+		self.db.executemany("INSERT OR IGNORE INTO fingerprints VALUES (?)", ((self.key(f),) for f in self.entries))
+		self.entries = set()
+
+	def close(self):
+		if self.db:
+			self.db.close()
+			self.tempdir.cleanup()
+			self.db = None
+
+
+class SpillingDict(object):
+	# Row-tuple -> line number map that moves to a temporary SQLite file once it
+	# outgrows its memory budget
+	bytesPerEntry = 256
+
+	def __init__(self, sizeInBytes):
+		self.sizeInBytes = sizeInBytes
+		self.maxEntries = max(sizeInBytes // SpillingDict.bytesPerEntry, 1)
+		self.entries = {}
+		self.tempdir = None
+		self.db = None
+
+	def key(self, rowTuple):
+		return '\x1f'.join(value or '' for value in rowTuple)
+
+	def get(self, rowTuple):
+		if self.db:
+			found = self.db.execute("SELECT line FROM rows WHERE key = ?", (self.key(rowTuple),)).fetchone()
+			return found[0] if found else None
+
+		return self.entries.get(rowTuple)
+
+	def put(self, rowTuple, line):
+		if self.db:
+			self.db.execute("INSERT INTO rows VALUES (?, ?)", (self.key(rowTuple), line))
+			return
+
+		self.entries[rowTuple] = line
+
+		if len(self.entries) > self.maxEntries:
+			self.spill()
+
+	def spill(self):
+		self.tempdir = tempfile.TemporaryDirectory()
+		self.db = sqlite3.connect(os.path.join(self.tempdir.name, 'rows.sqlite'))
+		self.db.execute("PRAGMA cache_size = -{}".format(max(self.sizeInBytes // 1024, 64))) # KiB, counted in the budget
+		self.db.execute("CREATE TABLE rows (key TEXT PRIMARY KEY, line INTEGER)")
+		self.db.executemany("INSERT INTO rows VALUES (?, ?)", ((self.key(k), v) for k, v in self.entries.items()))
+		self.entries = {}
+
+	def close(self):
+		if self.db:
+			self.db.close()
+			self.tempdir.cleanup()
+			self.db = None
+
+
 class GeneralPrecinctVerifier(Verifier):
 	pass
 
 class PrimaryPrecinctVerifier(Verifier):
-	def verifyParty(self, row):
+	def partyError(self, candidate, party):
 		if self.showPrimaryPartiesError:
-			if not row['party']:
-				self.printError("Primary results must include a party for every row", row)
+			if not party:
+				return "Primary results must include a party for every row"
 
 class SpecialPrecinctVerifier(Verifier):
 	pass
@@ -0,0 +1,64 @@
+import os
+import csv
+import sys
+import unittest
+import tempfile
+import subprocess
+
+VERIFIER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src', 'verifier.py')
+
+# Reports the peak RSS (KiB on Linux) of the verifier run in a child process
+PEAK_RSS = """
+import resource, subprocess, sys
+output = subprocess.run([sys.executable] + sys.argv[1:], capture_output=True, text=True).stdout
+print(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+print(output, end='')
+"""
+
+class UniqueMemoryBudgetTest(unittest.TestCase):
+	def setUp(self):
+		self.tempdir = tempfile.TemporaryDirectory()
+		os.mkdir(os.path.join(self.tempdir.name, '2016'))
+
+	def tearDown(self):
+		self.tempdir.cleanup()
+
+	def writeResults(self, rowCount, duplicates=()):
+		path = os.path.join(self.tempdir.name, '2016', '20161108__de__general__precinct.csv')
+
+		with open(path, 'w', newline='') as f:
+			writer = csv.writer(f, lineterminator='\n')
+			writer.writerow(['county', 'election_district', 'office', 'district', 'party', 'candidate', 'votes'])
+
+			for i in list(range(rowCount)) + list(duplicates):
+				writer.writerow(['Kent', '{:04d}-{:03d}'.format(i // 1000, i % 1000), 'President', '', 'DEM', 'Smith J', '5'])
+
+		return path
+
+	def verify(self, path, *args):
+		result = subprocess.run([sys.executable, '-c', PEAK_RSS, VERIFIER] + list(args) + [path],
+								capture_output=True, text=True, check=True)
+		peak, output = result.stdout.split('\n', 1)
+		return int(peak) / 1024, output
+
+	def testDuplicatesAreConfirmed(self):
+		path = self.writeResults(20000, duplicates=[5, 19999])
+		peak, output = self.verify(path, '--uniqueMemoryBudget', '1')
+
+		self.assertIn("ERROR: Line 20002: Line is duplicated (original line 7)", output)
+		self.assertIn("ERROR: Line 20003: Line is duplicated (original line 20001)", output)
+		self.assertEqual(output.count("ERROR"), 2)
+
+	def testPeakMemoryStaysWithinBudgetWhenFilterIsSaturated(self):
+		# The 64 KB filter of a 1/8 MB budget is saturated well before 300,000
+		# unique rows, so most rows become suspect fingerprints
+		budget = 0.125
+		baseline, output = self.verify(self.writeResults(10), '--uniqueMemoryBudget', str(budget))
+		peak, output = self.verify(self.writeResults(300000), '--uniqueMemoryBudget', str(budget))
+
+		self.assertNotIn("ERROR", output)
+		self.assertLessEqual(peak - baseline, budget + 2) # Allow for allocator and interpreter noise
+
+
+if __name__ == '__main__':
+	unittest.main()